@@ -1,9 +1,13 @@
+import functools
 import os
 import io
-from datetime import datetime
+import threading
+from datetime import date, datetime
+from pathlib import Path
 from typing import Tuple, List
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 from openpyxl import Workbook, load_workbook
 from openpyxl.worksheet.worksheet import Worksheet
@@ -24,6 +28,10 @@ SPANISH_MONTHS = [
 DON_START, DON_END = 3, 102       # Donaciones: filas 3–102
 EXP_START, EXP_END = 106, 205     # Gastos: filas 106–205
 
+# Encabezado común de ambas secciones (constante de módulo: no se
+# reconstruye en cada llamada del camino caliente de lectura)
+_HEADER_ROW = ("Fecha", "Descripción", "Monto")
+
 
 # ------------------------------------------------------------
 # FUNCIONES DE ARCHIVO
@@ -42,79 +50,173 @@ def ensure_workbook(path: str):
         wb.save(path)
 
 
-def openpyxl_get_ws(wb, sheet_name: str) -> Worksheet:
+@functools.lru_cache(maxsize=1)
+def _ensure_once(path: str) -> bool:
+    # El archivo nunca se borra en caliente: tras la primera verificación
+    # el os.path.exists repetido es puro overhead.
+    ensure_workbook(path)
+    return True
+
+
+def _get_ws_readonly(wb, sheet_name: str):
+    # Solo lectura: si la hoja no existe, el mes está vacío y no se crea nada.
+    if sheet_name in wb.sheetnames:
+        return wb[sheet_name]
+    return None
+
+
+def _get_or_create_ws(wb, sheet_name: str) -> Worksheet:
     if sheet_name in wb.sheetnames:
         return wb[sheet_name]
     ws = wb.create_sheet(sheet_name)
-    # Encabezados Donaciones
-    ws["A1"] = "DONACIONES"
-    ws["A2"], ws["B2"], ws["C2"] = "Fecha", "Descripción", "Monto"
-    # Encabezados Gastos (separados internamente)
+    # Encabezados Donaciones (append escribe la fila completa de una vez)
+    ws.append(["DONACIONES"])
+    ws.append(_HEADER_ROW)
+    # Encabezados Gastos: filas lejanas, se escriben directo sin rellenar
+    # con un centenar de filas vacías intermedias.
     ws["A105"] = "GASTOS (Comida y Meriendas)"
-    ws["A106"], ws["B106"], ws["C106"] = "Fecha", "Descripción", "Monto"
-    wb.save(FILE_NAME)
+    ws["A106"], ws["B106"], ws["C106"] = _HEADER_ROW
     return ws
 
 
+def _coerce_date(v):
+    # Las fechas se escriben siempre como ISO (d_date.isoformat()), así que
+    # fromisoformat basta; pd.to_datetime multiplica el costo por elemento.
+    if isinstance(v, str) and len(v) == 10:
+        try:
+            return date.fromisoformat(v)
+        except ValueError:
+            return v
+    if isinstance(v, datetime):
+        return v.date()
+    return v
+
+
+def _read_rows(ws: Worksheet, start_row: int, end_row: int) -> List[tuple]:
+    # Tuplas crudas de la sección, sin envolver en pandas: los caminos que
+    # solo necesitan totales (_sum_amounts) nunca pagan un DataFrame.
+    return [
+        r
+        for r in ws.iter_rows(min_row=start_row, max_row=end_row, min_col=1, max_col=3, values_only=True)
+        if any(v is not None for v in r)
+    ]
+
+
 def read_table(ws: Worksheet, start_row: int, end_row: int) -> pd.DataFrame:
-    rows = []
-    for row in range(start_row, end_row + 1):
-        c1, c2, c3 = ws.cell(row=row, column=1).value, ws.cell(row=row, column=2).value, ws.cell(row=row, column=3).value
-        if c1 is None and c2 is None and c3 is None:
-            continue
-        rows.append([c1, c2, c3])
-    df = pd.DataFrame(rows, columns=["Fecha", "Descripción", "Monto"])
+    rows = _read_rows(ws, start_row, end_row)
+    df = pd.DataFrame(rows, columns=_HEADER_ROW)
     if not df.empty:
-        try:
-            df["Fecha"] = pd.to_datetime(df["Fecha"]).dt.date
-        except Exception:
-            pass
-        df["Monto"] = pd.to_numeric(df["Monto"], errors="coerce").fillna(0.0)
+        df["Fecha"] = [_coerce_date(v) for v in df["Fecha"]]
+        # openpyxl ya entrega int/float en las celdas numéricas; basta con
+        # sustituir los valores no numéricos por 0.0, sin pasar por pandas.
+        df["Monto"] = np.fromiter(
+            (v if isinstance(v, (int, float)) else 0.0 for _, _, v in rows),
+            dtype=np.float64,
+            count=len(rows),
+        )
     return df
 
 
-def append_row(ws: Worksheet, start_row: int, end_row: int, values: List):
-    for row in range(start_row, end_row + 1):
-        if all(ws.cell(row=row, column=c).value is None for c in range(1, 4)):
-            for col, val in enumerate(values, start=1):
-                ws.cell(row=row, column=col).value = val
+def _write_row(ws: Worksheet, row: int, values: List):
+    if row == ws.max_row + 1:
+        # Justo después de la última fila ocupada: append escribe la fila
+        # entera en una sola llamada.
+        ws.append(values)
+    else:
+        for col, val in enumerate(values, start=1):
+            ws.cell(row=row, column=col).value = val
+
+
+def append_row(ws: Worksheet, start_row: int, end_row: int, values: List, next_row: int = None):
+    # next_row viene de la sesión (inicio de sección + filas ya leídas) y
+    # evita sondear la sección celda por celda; sin pista, se recorre.
+    if next_row is not None and start_row <= next_row:
+        if next_row > end_row:
+            st.error("⚠️ Se alcanzó el límite de 100 registros en esta sección.")
+            return
+        if all(ws.cell(row=next_row, column=c).value is None for c in range(1, 4)):
+            _write_row(ws, next_row, values)
+            return
+    row_values = ws.iter_rows(min_row=start_row, max_row=end_row, min_col=1, max_col=3, values_only=True)
+    for row, current in enumerate(row_values, start=start_row):
+        if all(v is None for v in current):
+            _write_row(ws, row, values)
             return
     st.error("⚠️ Se alcanzó el límite de 100 registros en esta sección.")
 
 
 def clear_month_data(ws: Worksheet):
-    for row in range(DON_START, DON_END + 1):
-        for col in range(1, 4):
-            ws.cell(row=row, column=col).value = None
-    for row in range(EXP_START, EXP_END + 1):
-        for col in range(1, 4):
-            ws.cell(row=row, column=col).value = None
+    # Una sola pasada por cada rango en vez de 600 llamadas a ws.cell().
+    for start, end in ((DON_START, DON_END), (EXP_START, EXP_END)):
+        for row in ws.iter_rows(min_row=start, max_row=end, min_col=1, max_col=3):
+            for cell in row:
+                cell.value = None
 
 
 def get_month_data(year: int, month: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    ensure_workbook(FILE_NAME)
-    wb = load_workbook(FILE_NAME)
-    ws = openpyxl_get_ws(wb, month_sheet_name(year, month))
+    _ensure_once(FILE_NAME)
+    wb = load_workbook(FILE_NAME, read_only=True, data_only=True, keep_links=False)
+    ws = _get_ws_readonly(wb, month_sheet_name(year, month))
+    if ws is None:
+        wb.close()
+        empty = pd.DataFrame(columns=_HEADER_ROW)
+        return empty, empty.copy()
     donations = read_table(ws, DON_START, DON_END)
     expenses = read_table(ws, EXP_START, EXP_END)
-    wb.save(FILE_NAME)
+    wb.close()
     return donations, expenses
 
 
+@st.cache_resource
+def _wb_handle(mtime: float) -> Workbook:
+    # Libro abierto compartido entre sesiones; la clave mtime invalida el
+    # handle cuando el archivo cambia en disco.
+    return load_workbook(FILE_NAME)
+
+
+def get_wb() -> Workbook:
+    _ensure_once(FILE_NAME)
+    return _wb_handle(os.path.getmtime(FILE_NAME))
+
+
+@st.cache_resource
+def _write_lock() -> threading.Lock:
+    # cache_resource mantiene el lock vivo entre reruns y sesiones.
+    return threading.Lock()
+
+
+def append_to_section(year: int, month: int, start_row: int, end_row: int, values: List, next_row: int = None):
+    # Una sola apertura y un solo guardado por envío de formulario, aunque
+    # haya que crear la hoja del mes sobre la marcha. El lock serializa las
+    # mutaciones: el Workbook compartido de cache_resource no es thread-safe.
+    with _write_lock():
+        wb = get_wb()
+        ws = _get_or_create_ws(wb, month_sheet_name(year, month))
+        append_row(ws, start_row, end_row, values, next_row=next_row)
+        wb.save(FILE_NAME)
+        # El guardado cambia el mtime; se descarta el handle para que la
+        # próxima lectura use la clave nueva.
+        _wb_handle.clear()
+
+
 def add_donation(year: int, month: int, date_str: str, desc: str, amount: float):
-    ensure_workbook(FILE_NAME)
-    wb = load_workbook(FILE_NAME)
-    ws = openpyxl_get_ws(wb, month_sheet_name(year, month))
-    append_row(ws, DON_START, DON_END, [date_str, desc, amount])
-    wb.save(FILE_NAME)
+    next_row = st.session_state.get(f"next_don_row_{month_sheet_name(year, month)}")
+    append_to_section(year, month, DON_START, DON_END, [date_str, desc, amount], next_row)
 
 
 def add_expense(year: int, month: int, date_str: str, desc: str, amount: float):
-    ensure_workbook(FILE_NAME)
-    wb = load_workbook(FILE_NAME)
-    ws = openpyxl_get_ws(wb, month_sheet_name(year, month))
-    append_row(ws, EXP_START, EXP_END, [date_str, desc, amount])
-    wb.save(FILE_NAME)
+    next_row = st.session_state.get(f"next_exp_row_{month_sheet_name(year, month)}")
+    append_to_section(year, month, EXP_START, EXP_END, [date_str, desc, amount], next_row)
+
+
+def _sum_amounts(ws, start_row: int, end_row: int) -> float:
+    # Acumula la columna Monto sin construir DataFrames: en el rollup anual
+    # solo interesan los totales, no las tablas.
+    total = 0.0
+    for _, _, amount in ws.iter_rows(min_row=start_row, max_row=end_row, min_col=1, max_col=3, values_only=True):
+        if isinstance(amount, (int, float)):
+            total += amount
+    return total
 
 
 def monthly_totals(don_df: pd.DataFrame, exp_df: pd.DataFrame) -> Tuple[float, float]:
@@ -123,13 +225,54 @@ def monthly_totals(don_df: pd.DataFrame, exp_df: pd.DataFrame) -> Tuple[float, f
     return d_total, e_total
 
 
+@st.cache_data(ttl=24 * 60 * 60)
+def yearly_cum_balance(year: int, initial: float, mtime: float) -> List[float]:
+    # Saldo acumulado al inicio de cada mes, en una sola pasada por el
+    # archivo. mtime forma parte de la clave de caché: cualquier escritura
+    # cambia la fecha de modificación y fuerza una relectura.
+    wb = load_workbook(FILE_NAME, read_only=True, data_only=True, keep_links=False)
+    out = [float(initial)]
+    for m in range(1, 13):
+        ws = _get_ws_readonly(wb, month_sheet_name(year, m))
+        if ws is None:
+            d, e = 0.0, 0.0
+        else:
+            d = _sum_amounts(ws, DON_START, DON_END)
+            e = _sum_amounts(ws, EXP_START, EXP_END)
+        out.append(out[-1] + d - e)
+    wb.close()
+    return out
+
+
 def compute_previous_balance_for_month(year: int, month: int, initial_prev_jan: float) -> float:
-    prev = float(initial_prev_jan)
-    for m in range(1, month):
-        don, exp = get_month_data(year, m)
-        d, e = monthly_totals(don, exp)
-        prev = prev + d - e
-    return prev
+    _ensure_once(FILE_NAME)
+    mtime = os.path.getmtime(FILE_NAME)
+    return yearly_cum_balance(year, initial_prev_jan, mtime)[month - 1]
+
+
+@st.cache_data(ttl=24 * 60 * 60)
+def _pie_png(values: Tuple[float, ...], labels: Tuple[str, ...], title: str) -> bytes:
+    fig = plt.figure(figsize=(4, 4))
+    plt.pie(values, labels=labels, autopct="%1.1f%%", startangle=90)
+    plt.title(title)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    plt.close(fig)
+    return buf.getvalue()
+
+
+@st.cache_data(ttl=24 * 60 * 60)
+def _file_bytes(mtime: float) -> bytes:
+    # Bytes del archivo para el botón de descarga; la clave mtime evita
+    # releer el disco en cada rerun mientras el archivo no cambie.
+    return Path(FILE_NAME).read_bytes()
+
+
+@st.cache_data
+def make_qr_png(url: str) -> bytes:
+    buf = io.BytesIO()
+    qrcode.make(url).save(buf, format="PNG")
+    return buf.getvalue()
 
 
 # ------------------------------------------------------------
@@ -165,6 +308,11 @@ st.subheader(f"Mes: {SPANISH_MONTHS[month]} {year}")
 # Datos
 donations_df, expenses_df = get_month_data(year, month)
 
+# Próxima fila libre de cada sección (las inserciones son secuenciales)
+_sheet = month_sheet_name(year, month)
+st.session_state[f"next_don_row_{_sheet}"] = DON_START + len(donations_df)
+st.session_state[f"next_exp_row_{_sheet}"] = EXP_START + len(expenses_df)
+
 # Formularios
 col1, col2 = st.columns(2)
 with col1:
@@ -214,30 +362,34 @@ st.dataframe(expenses_df, use_container_width=True)
 st.divider()
 col_g1, col_g2 = st.columns(2)
 with col_g1:
-    fig1 = plt.figure(figsize=(4, 4))
-    plt.pie([prev_balance, don_total], labels=["Saldo Previo", "Donaciones"], autopct="%1.1f%%", startangle=90)
-    plt.title("Origen de fondos")
-    st.pyplot(fig1)
+    if (prev_balance + don_total) > 0:
+        st.image(_pie_png(
+            (round(prev_balance, 2), round(don_total, 2)),
+            ("Saldo Previo", "Donaciones"),
+            "Origen de fondos",
+        ))
+    else:
+        st.info("Sin datos suficientes")
 with col_g2:
-    fig2 = plt.figure(figsize=(4, 4))
-    plt.pie([exp_total, max(remaining, 0)], labels=["Gastado", "Restante"], autopct="%1.1f%%", startangle=90)
-    plt.title("Uso del presupuesto")
-    st.pyplot(fig2)
+    if (exp_total + max(remaining, 0)) > 0:
+        st.image(_pie_png(
+            (round(exp_total, 2), round(max(remaining, 0), 2)),
+            ("Gastado", "Restante"),
+            "Uso del presupuesto",
+        ))
+    else:
+        st.info("Sin datos suficientes")
 
 # Descargar Excel
 if os.path.exists(FILE_NAME):
-    with open(FILE_NAME, "rb") as f:
-        st.download_button("Descargar Excel del año", f, FILE_NAME)
+    st.download_button("Descargar Excel del año", _file_bytes(os.path.getmtime(FILE_NAME)), FILE_NAME)
 
 # QR
 st.divider()
 st.subheader("Código QR para compartir")
 url = st.text_input("URL pública del dashboard")
-if st.button("Generar QR") and url.strip():
-    qr_img = qrcode.make(url.strip())
-    buf = io.BytesIO()
-    qr_img.save(buf, format="PNG")
-    st.image(buf.getvalue(), caption="Escanea para abrir")
+if url.strip():
+    st.image(make_qr_png(url.strip()), caption="Escanea para abrir")
 
 # ------------------------------------------------------------
 # BOTÓN ADMIN: VACIAR MES
@@ -245,10 +397,12 @@ if st.button("Generar QR") and url.strip():
 if editing_enabled:
     st.divider()
     if st.button("🗑️ Vaciar mes actual"):
-        wb = load_workbook(FILE_NAME)
-        ws = openpyxl_get_ws(wb, month_sheet_name(year, month))
-        clear_month_data(ws)
-        wb.save(FILE_NAME)
+        with _write_lock():
+            wb = get_wb()
+            ws = _get_or_create_ws(wb, month_sheet_name(year, month))
+            clear_month_data(ws)
+            wb.save(FILE_NAME)
+            _wb_handle.clear()
         st.rerun()
 
 st.caption("© Consejo Estudiantil — Streamlit, OpenPyXL, Matplotlib y QRCode")